@@ -1,16 +1,28 @@
 import argparse
 import logging
+import struct
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, tzinfo
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import apache_beam as beam
+import numpy as np
 import pandas as pd
-from apache_beam.io import ReadFromBigQuery, WriteToText
+import pyarrow as pa
+from apache_beam.io import ReadFromBigQuery
+from apache_beam.io.fileio import FileMetadata, FileSink, WriteToFiles, default_file_naming
+from apache_beam.io.filesystem import CompressionTypes
+from apache_beam.io.filesystems import FileSystems
 from apache_beam.options.pipeline_options import PipelineOptions, SetupOptions
-from apache_beam.typehints.batch import BatchConverter, ListBatchConverter
+from apache_beam.transforms.window import GlobalWindows
+from apache_beam.typehints import typehints
+from apache_beam.typehints.batch import BATCH_CONVERTER_REGISTRY, ListBatchConverter
+from apache_beam.utils.windowed_value import WindowedValue
 from dateutil import tz
+from whylogs.api.writer.whylabs import WhyLabsWriter
 from whylogs.core import DatasetProfile, DatasetProfileView
 
 
@@ -30,8 +42,22 @@ class TemplateArgs:
     logging_level: str
     date_column: str
     date_grouping_frequency: str
+    profile_threads: int
+    columns: Optional[str]
 
 
+# Bounds for the number of rows that ProfileViews turns into a DataFrame at once.
+PROFILE_MIN_BATCH_SIZE = 20000
+PROFILE_MAX_BATCH_SIZE = 50000
+
+# How many profiles each worker uploads to WhyLabs at once.
+WHYLABS_UPLOAD_THREADS = 16
+
+
+# Declared on the CombineFn because CombinePerKey(...).with_output_types doesn't reach the output
+# PCollection, which would otherwise be Tuple[str, Any] and miss ProfileIndexBatchConverter.
+@beam.typehints.with_input_types(DatasetProfileView)
+@beam.typehints.with_output_types(DatasetProfileView)
 class ViewCombiner(beam.CombineFn):
     def __init__(self, args: TemplateArgs):
         self.logger = logging.getLogger("ViewCombiner")
@@ -40,21 +66,37 @@ class ViewCombiner(beam.CombineFn):
     def setup(self) -> None:
         self.logger.setLevel(logging.getLevelName(self.logging_level))
 
-    def create_accumulator(self) -> DatasetProfileView:
-        return DatasetProfile().view()
-
-    def add_input(self, accumulator: DatasetProfileView, input: DatasetProfileView) -> DatasetProfileView:
+    def create_accumulator(self) -> Optional[DatasetProfileView]:
+        # None stands in for an empty view. Starting from DatasetProfile().view() would cost
+        # a full merge for the first input, and the merged dataset timestamp would be the min
+        # of the input's and the time that the empty profile was created.
+        return None
+
+    def add_input(
+        self, accumulator: Optional[DatasetProfileView], input: DatasetProfileView
+    ) -> Optional[DatasetProfileView]:
+        if accumulator is None:
+            return input
         return accumulator.merge(input)
 
-    def merge_accumulators(self, accumulators: List[DatasetProfileView]) -> DatasetProfileView:
-        view: DatasetProfileView = DatasetProfile().view()
+    def merge_accumulators(self, accumulators: Iterable[Optional[DatasetProfileView]]) -> Optional[DatasetProfileView]:
+        # Views are immutable so the first one can be used as the starting point
+        # without affecting the inputs.
+        view: Optional[DatasetProfileView] = None
         for current_view in accumulators:
-            view = view.merge(current_view)
+            if current_view is None:
+                continue
+            view = current_view if view is None else view.merge(current_view)
         return view
 
-    def extract_output(self, accumulator: DatasetProfileView) -> DatasetProfileView:
+    def extract_output(self, accumulator: Optional[DatasetProfileView]) -> DatasetProfileView:
+        if accumulator is None:
+            return DatasetProfile().view()
         return accumulator
 
+    def get_accumulator_coder(self) -> beam.coders.Coder:
+        return beam.coders.NullableCoder(DatasetProfileViewCoder())
+
 
 class ProfileViews(beam.DoFn):
     def __init__(self, args: TemplateArgs):
@@ -62,40 +104,166 @@ class ProfileViews(beam.DoFn):
         self.freq = args.date_grouping_frequency
         self.logging_level = args.logging_level
         self.logger = logging.getLogger("ProfileViews")
+        self.freq_nanos = _fixed_frequency_nanos(self.freq)
+        self.profile_threads = args.profile_threads
 
     def setup(self) -> None:
         self.logger.setLevel(logging.getLevelName(self.logging_level))
+        # Checked once here so that the per batch debug logging costs nothing when it's off.
+        self.debug = self.logger.isEnabledFor(logging.DEBUG)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if self.profile_threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.profile_threads)
+
+    def teardown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _group_by_date(self, df: pd.DataFrame) -> Iterator[Tuple[pd.Timestamp, pd.DataFrame]]:
+        dates = df[self.date_column]
+        if not pd.api.types.is_datetime64_any_dtype(dates.dtype):
+            # Arrow already hands TIMESTAMP columns over as datetime64 and to_datetime would still hash
+            # every value for its cache, so only columns like DATE (datetime.date objects) get parsed.
+            dates = pd.to_datetime(dates, cache=True)
+        date_tz = dates.dt.tz
+
+        if self.freq_nanos is None or (date_tz is not None and date_tz.utcoffset(None) is None):
+            # Calendar frequencies (W, M, Y, ...) and timezones with DST don't have fixed width bins,
+            # so pandas has to do the binning.
+            tmp_date_col = "_whylogs_datetime"
+            df[tmp_date_col] = dates
+            for date_group, dataframe in df.set_index(tmp_date_col).groupby(pd.Grouper(freq=self.freq)):
+                # pandas includes every date in the range, not just the ones that had rows...
+                # https://github.com/pandas-dev/pandas/issues/47963
+                if len(dataframe) > 0:
+                    yield date_group, dataframe
+            return
+
+        # Fixed frequencies can be bucketed directly on the int64 timestamps. This only visits the buckets
+        # that actually have rows, unlike Grouper, which is very slow for sparse data (see the issue above).
+        present = dates.notna().to_numpy()
+        if not present.all():
+            df = df[present]
+            dates = dates[present]
+
+        if len(df) == 0:
+            return
+
+        # Same bin edges that Grouper uses by default (origin="start_day")
+        origin = dates.min().floor("D").value
+        nanos = dates.values.view("i8")
+        buckets = origin + ((nanos - origin) // self.freq_nanos) * self.freq_nanos
+        codes, uniques = pd.factorize(buckets, sort=True)
+
+        if len(uniques) == 1:
+            yield pd.Timestamp(uniques[0], tz=date_tz), df
+            return
+
+        # Sort once so that each group is a contiguous slice instead of a full scan per group.
+        order = np.argsort(codes, kind="stable")
+        sorted_df = df.take(order)
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        for i, bucket in enumerate(uniques):
+            yield pd.Timestamp(bucket, tz=date_tz), sorted_df.iloc[bounds[i] : bounds[i + 1]]
+
+    def start_bundle(self) -> None:
+        # Profiles are accumulated for the whole bundle so that each worker emits a single
+        # profile per date group instead of one per batch, which keeps the shuffle into
+        # the combine step small.
+        self.profiles: Dict[str, DatasetProfile] = {}
+
+    def process(self, batch: List[Dict[str, Any]]) -> None:
+        if self.debug:
+            start_time = time.perf_counter()
+        df = rows_to_dataframe(batch)
+
+        groups: List[Tuple[DatasetProfile, pd.DataFrame]] = []
+        for date_group, dataframe in self._group_by_date(df):
+            date_str = str(date_group)
+            profile = self.profiles.get(date_str)
+            if profile is None:
+                ts: datetime = date_group.to_pydatetime()
+                profile = DatasetProfile(dataset_timestamp=ts)
+                self.profiles[date_str] = profile
+                if self.debug:
+                    self.logger.debug(
+                        "Created dataset profile with timestamp %s for grouper date %s, tzinfo %s",
+                        profile.dataset_timestamp,
+                        ts,
+                        ts.tzinfo,
+                    )
+            groups.append((profile, dataframe))
+
+        # Each date group has its own profile so they can be tracked independently.
+        if self.executor is None or len(groups) < 2:
+            for group in groups:
+                _track_group(group)
+        else:
+            for _ in self.executor.map(_track_group, groups):
+                pass
 
-    @beam.DoFn.yields_elements
-    def process_batch(self, batch: List[Dict[str, Any]]) -> Iterator[Tuple[str, DatasetProfileView]]:
-        start_time = time.perf_counter()
-        tmp_date_col = "_whylogs_datetime"
-        df = pd.DataFrame(batch)
-        df[tmp_date_col] = pd.to_datetime(df[self.date_column])
-        grouped = df.set_index(tmp_date_col).groupby(pd.Grouper(freq=self.freq))
-
-        # profiles = ProfileIndex()
-        results: List[Tuple[str, DatasetProfileView]] = []
-        for date_group, dataframe in grouped:
-            # pandas includes every date in the range, not just the ones that had rows...
-            # https://github.com/pandas-dev/pandas/issues/47963
-            if len(dataframe) == 0:
-                continue
-
-            ts: datetime = date_group.to_pydatetime()
-            profile = DatasetProfile(dataset_timestamp=ts)
+        if self.debug:
+            total_time = time.perf_counter() - start_time
             self.logger.debug(
-                "Created dataset profile with timestamp %s for grouper date %s, tzinfo %s",
-                profile.dataset_timestamp,
-                ts,
-                ts.tzinfo,
+                "[%.4f] Processing batch of size %s into %s profiles", total_time, len(batch), len(groups)
             )
-            profile.track(dataframe)
-            yield (str(date_group), profile.view())
 
-        end_time = time.perf_counter()
-        total_time = end_time - start_time
-        self.logger.debug(f"[{total_time:.4f}] Processing batch of size %s into %s profiles", len(batch), len(results))
+    def finish_bundle(self) -> Iterator[WindowedValue]:
+        for date_str, profile in self.profiles.items():
+            yield GlobalWindows.windowed_value((date_str, profile.view()))
+        self.profiles = {}
+
+
+def _track_group(group: Tuple[DatasetProfile, pd.DataFrame]) -> None:
+    profile, dataframe = group
+    profile.track(dataframe)
+
+
+def rows_to_dataframe(batch: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Converts BigQuery rows into a DataFrame by way of Arrow, which builds each
+    column in one pass in C++ instead of pandas pivoting the row dicts in Python.
+    """
+    # Arrow only takes the columns from the first row, while pandas uses every key that it sees. If
+    # there are as many distinct keys as keys in every row, then every row has the same keys.
+    if len(batch) > 0:
+        column_count = len(batch[0])
+        if min(map(len, batch)) != column_count or len(set().union(*batch)) != column_count:
+            return pd.DataFrame(batch)
+
+    try:
+        table = pa.Table.from_pylist(batch)
+    except pa.ArrowException:
+        return pd.DataFrame(batch)
+
+    # Arrow converts REPEATED and RECORD fields into numpy arrays, down to the ones nested inside of
+    # dicts, but they should be profiled in the same form that BigQuery hands them to us in. Those
+    # columns are taken straight from the rows instead.
+    nested_columns = [(i, field.name) for i, field in enumerate(table.schema) if pa.types.is_nested(field.type)]
+    if len(nested_columns) > 0:
+        table = table.drop([name for _, name in nested_columns])
+
+    try:
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+    except pa.ArrowException:
+        # Things like timestamps outside of the range that pandas can represent
+        return pd.DataFrame(batch)
+
+    for i, name in nested_columns:
+        df.insert(i, name, [row[name] for row in batch])
+
+    return df
+
+
+def _fixed_frequency_nanos(freq: str) -> Optional[int]:
+    """
+    Returns the width of freq in nanoseconds, or None if it's a calendar
+    frequency (like W, M or Y) that doesn't have a fixed width.
+    """
+    try:
+        return int(pd.tseries.frequencies.to_offset(freq).nanos)
+    except ValueError:
+        return None
 
 
 class UploadToWhylabsFn(beam.DoFn):
@@ -105,47 +273,174 @@ class UploadToWhylabsFn(beam.DoFn):
 
     def setup(self) -> None:
         self.logger.setLevel(logging.getLevelName(self.args.logging_level))
+        self.writer = WhyLabsWriter(org_id=self.args.org_id, api_key=self.args.api_key, dataset_id=self.args.dataset_id)
+        self.executor = ThreadPoolExecutor(max_workers=WHYLABS_UPLOAD_THREADS)
 
-    def process_batch(
-        self, batch: List[Tuple[str, DatasetProfileView]]
-    ) -> Iterator[List[Tuple[str, DatasetProfileView]]]:
-        from whylogs.api.writer.whylabs import WhyLabsWriter
+    def teardown(self) -> None:
+        self.executor.shutdown()
 
-        writer = WhyLabsWriter(org_id=self.args.org_id, api_key=self.args.api_key, dataset_id=self.args.dataset_id)
+    def start_bundle(self) -> None:
+        self.pending: List[Tuple[str, DatasetProfileView]] = []
 
-        for date_str, view in batch:
-            self.logger.info(
-                "Writing dataset profile to %s:%s for timestamp %s.", self.args.org_id, self.args.dataset_id, date_str
-            )
-            self.logger.info("Dataset profile's internal dataset timestamp is %s", view.dataset_timestamp)
-            writer.write(view)
+    @beam.DoFn.yields_elements
+    def process_batch(self, batch: List[Tuple[str, DatasetProfileView]]) -> None:
+        # Uploads are network bound, so they're collected for the whole bundle and sent
+        # concurrently when it finishes rather than one at a time as batches arrive.
+        self.pending.extend(batch)
+
+    def finish_bundle(self) -> None:
+        for (date_str, _), (success, message) in zip(self.pending, self.executor.map(self._upload, self.pending)):
+            if not success:
+                self.logger.error("Failed to upload dataset profile for timestamp %s: %s", date_str, message)
+        self.pending = []
+
+    def _upload(self, item: Tuple[str, DatasetProfileView]) -> Tuple[bool, str]:
+        date_str, view = item
+        self.logger.info(
+            "Writing dataset profile to %s:%s for timestamp %s.", self.args.org_id, self.args.dataset_id, date_str
+        )
+        self.logger.info("Dataset profile's internal dataset timestamp is %s", view.dataset_timestamp)
+        result: Tuple[bool, str] = self.writer.write(view)
+        return result
+
+
+# The serialized form of views that were already serialized or deserialized once. Views are never
+# modified after they're created (merging creates a new view), so the bytes stay valid for as long
+# as the view is alive, and a view that goes straight from a shuffle to the GCS and WhyLabs forks
+# doesn't have to be serialized again each time.
+_serialized_views: "weakref.WeakKeyDictionary[DatasetProfileView, bytes]" = weakref.WeakKeyDictionary()
+
+
+def serialize_view(view: DatasetProfileView) -> bytes:
+    serialized = _serialized_views.get(view)
+    if serialized is None:
+        serialized = view.serialize()
+        _serialized_views[view] = serialized
+    return serialized
 
-        yield batch
 
+def deserialize_view(serialized: bytes) -> DatasetProfileView:
+    view = DatasetProfileView.deserialize(serialized)
+    _serialized_views[view] = serialized
+    return view
 
-def serialize_profiles(input: Tuple[str, DatasetProfileView]) -> List[bytes]:
+
+class DatasetProfileViewSink(FileSink):
+    """
+    Writes (date, DatasetProfileView) pairs as serialized profiles, each one
+    preceded by its length as a 4 byte big endian unsigned int. This lets a
+    single file hold many profiles, which saves a GCS upload per profile. The
+    files are zstd compressed since the profiles have a lot of repeated
+    structure. Use read_profiles to get them back out.
+    """
+
+    def create_metadata(self, destination: str, full_file_name: str) -> FileMetadata:
+        return FileMetadata(mime_type="application/zstd", compression_type=CompressionTypes.ZSTD)
+
+    def open(self, fh: Any) -> None:
+        self._fh = fh
+
+    def write(self, record: Tuple[str, DatasetProfileView]) -> None:
+        serialized = serialize_view(record[1])
+        self._fh.write(struct.pack(">I", len(serialized)))
+        self._fh.write(serialized)
+
+    def flush(self) -> None:
+        # WriteToFiles closes the handle right after this, which writes out the
+        # rest of the zstd frame. Flushing the compressed handle here would end
+        # the frame early and make the close fail.
+        pass
+
+
+def read_profiles(path: str) -> List[DatasetProfileView]:
     """
-    This function converts a single ProfileIndex into a collection of
-    serialized DatasetProfileViews so that they can subsequently be written
-    individually to GCS, rather than as a giant collection that has to be
-    parsed in a special way to get it back into a DatasetProfileView.
+    Reads the dataset profiles back out of a file written by the template.
+    Works for local paths and gs:// paths. The compression is determined by
+    the file extension.
     """
-    return [input[1].serialize()]
+    views: List[DatasetProfileView] = []
+    with FileSystems.open(path) as f:
+        header = f.read(4)
+        while header:
+            (length,) = struct.unpack(">I", header)
+            views.append(DatasetProfileView.deserialize(f.read(length)))
+            header = f.read(4)
+    return views
+
+
+# Rough serialized sizes of a column and of each of its metrics, measured on profiles of a few thousand
+# to a hundred thousand rows. The distribution and frequent items sketches make up most of it.
+ESTIMATED_COLUMN_BYTES = 128
+ESTIMATED_METRIC_BYTES = 2048
+
+
+def estimate_view_size(view: DatasetProfileView) -> int:
+    """
+    Estimates the serialized size of a view without serializing it, unless
+    the serialized form is already cached.
+    """
+    serialized = _serialized_views.get(view)
+    if serialized is not None:
+        return len(serialized)
+
+    return sum(
+        ESTIMATED_COLUMN_BYTES + ESTIMATED_METRIC_BYTES * len(column.get_metric_names())
+        for column in view.get_columns().values()
+    )
 
 
 class ProfileIndexBatchConverter(ListBatchConverter):
+    """
+    Batch converter for the (date, view) pairs that go into
+    UploadToWhylabsFn.process_batch. Beam only asks for the size estimate on
+    batches that a DoFn outputs, where ListBatchConverter would estimate it
+    by encoding a sample of them, which serializes the views.
+    """
+
+    ELEMENT_TYPE = typehints.Tuple[str, DatasetProfileView]
+
+    @staticmethod
+    def from_typehints(element_type: Any, batch_type: Any) -> Optional["ProfileIndexBatchConverter"]:
+        if element_type == ProfileIndexBatchConverter.ELEMENT_TYPE and batch_type == typehints.List[element_type]:
+            return ProfileIndexBatchConverter(batch_type, element_type)
+        return None
+
     def estimate_byte_size(self, batch: List[Tuple[str, DatasetProfileView]]) -> int:
         logger = logging.getLogger()
-        if len(batch) == 0:
-            return 0
-
-        estimate = len(batch[0][1].serialize())
+        # Beam divides this by the batch length to get the mean element size, so it has to cover
+        # every element.
+        estimate = sum(estimate_view_size(view) for _, view in batch)
 
-        logger.debug(f"Estimating size at {estimate} bytes")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Estimating size at %s bytes", estimate)
         return estimate
 
 
-BatchConverter.register(ProfileIndexBatchConverter)
+# Beam uses the first registered converter that accepts the types, and ListBatchConverter accepts any list.
+BATCH_CONVERTER_REGISTRY.insert(0, ProfileIndexBatchConverter.from_typehints)
+
+
+class DatasetProfileViewCoder(beam.coders.Coder):
+    """
+    Encodes DatasetProfileViews as their whylogs serialized form. Without this
+    Beam falls back to pickling them, which adds pickle framing around the same
+    bytes and goes through the slower generic object path on every shuffle.
+    """
+
+    def encode(self, value: DatasetProfileView) -> bytes:
+        return serialize_view(value)
+
+    def decode(self, encoded: bytes) -> DatasetProfileView:
+        return deserialize_view(encoded)
+
+    def is_deterministic(self) -> bool:
+        return False
+
+    def to_type_hint(self) -> Any:
+        return DatasetProfileView
+
+
+beam.coders.registry.register_coder(DatasetProfileView, DatasetProfileViewCoder)
 
 
 @dataclass
@@ -249,18 +544,58 @@ def get_input(args: TemplateArgs) -> Union[InputOffset, InputBigQuerySQL, InputB
         raise Exception(f"Unknown input_mode {args.input_mode}")
 
 
+def get_selected_fields(args: TemplateArgs) -> Optional[List[str]]:
+    """
+    Parses the comma separated --columns allowlist. The date column is always
+    included since it's needed to group the rows. None means every column.
+    """
+    if args.columns is None:
+        return None
+
+    columns = [column.strip() for column in args.columns.split(",") if column.strip() != ""]
+    if len(columns) == 0:
+        return None
+
+    if args.date_column not in columns:
+        columns.append(args.date_column)
+    return columns
+
+
 def get_read_input(args: TemplateArgs, logger: logging.Logger) -> ReadFromBigQuery:
     input = get_input(args)
 
+    # Read through the BigQuery Storage API rather than exporting to GCS first. use_native_datetime
+    # makes the Storage API return the rows in Arrow format instead of Avro.
+    method = ReadFromBigQuery.Method.DIRECT_READ
+
+    # The Storage API drops the other columns on the server, so they're never sent to the workers.
+    selected_fields = get_selected_fields(args)
+    if selected_fields is not None:
+        logger.info("Only reading columns %s", selected_fields)
+
     if isinstance(input, InputBigQuerySQL):
         logger.info("Using bigquery query %s", input.query)
-        return ReadFromBigQuery(query=input.query, use_standard_sql=True)
+        return ReadFromBigQuery(
+            query=input.query,
+            use_standard_sql=True,
+            method=method,
+            use_native_datetime=True,
+            selected_fields=selected_fields,
+        )
     elif isinstance(input, InputBigQueryTable):
         logger.info("Using bigquery table %s", input.table_spec)
-        return ReadFromBigQuery(table=input.table_spec)
+        return ReadFromBigQuery(
+            table=input.table_spec, method=method, use_native_datetime=True, selected_fields=selected_fields
+        )
     elif isinstance(input, InputOffset):
         logger.info("Using offset query %s", input.query)
-        return ReadFromBigQuery(query=input.query, use_standard_sql=True)
+        return ReadFromBigQuery(
+            query=input.query,
+            use_standard_sql=True,
+            method=method,
+            use_native_datetime=True,
+            selected_fields=selected_fields,
+        )
     else:
         # Can't happen unless we forget to check for a type of Input. Should be able to configure mypy to do this for us.
         raise Exception(f"Can't determine how to read data: {type(input)}")
@@ -321,6 +656,19 @@ def run() -> None:
         default="D",
         help="One of the freq options in the pandas Grouper(freq=) API. D for daily, W for weekly, etc.",
     )
+    parser.add_argument(
+        "--profile-threads",
+        dest="profile_threads",
+        type=int,
+        default=1,
+        help="How many threads each worker uses to profile the date groups in a batch. Only worth raising along with a lower --number_of_worker_harness_threads.",
+    )
+    parser.add_argument(
+        "--columns",
+        dest="columns",
+        required=False,
+        help="A comma separated list of the columns to profile. All columns are profiled by default.",
+    )
     parser.add_argument(
         "--logging-level",
         dest="logging_level",
@@ -363,6 +711,8 @@ def run() -> None:
         logging_level=known_args.logging_level,
         date_column=known_args.date_column,
         date_grouping_frequency=known_args.date_grouping_frequency,
+        profile_threads=known_args.profile_threads,
+        columns=known_args.columns,
     )
 
     logger = logging.getLogger()
@@ -375,6 +725,12 @@ def run() -> None:
         result = (
             p
             | "ReadTable" >> read_step.with_output_types(Dict[str, Any])
+            # Beam caps process_batch at 4096 elements, which is too small to amortize building a
+            # DataFrame and grouping it, so the rows are batched explicitly instead.
+            | "Batch rows"
+            >> beam.BatchElements(
+                min_batch_size=PROFILE_MIN_BATCH_SIZE, max_batch_size=PROFILE_MAX_BATCH_SIZE
+            ).with_output_types(List[Dict[str, Any]])
             | "Profile" >> beam.ParDo(ProfileViews(args)).with_output_types(Tuple[str, DatasetProfileView])
             # | 'Group into batches' >> beam.GroupIntoBatches(1000, max_buffering_duration_secs=60)
             #     .with_input_types(Tuple[str, DatasetProfileView])
@@ -388,12 +744,13 @@ def run() -> None:
             beam.ParDo(UploadToWhylabsFn(args)).with_input_types(Tuple[str, DatasetProfileView])
         )
 
-        # A fork that uploads to GCS, each dataset profile in serialized form, one per file.
-        (
-            result
-            | "Serialize Profiles"
-            >> beam.ParDo(serialize_profiles).with_input_types(Tuple[str, DatasetProfileView]).with_output_types(bytes)
-            | "Upload to GCS" >> WriteToText(args.output, max_records_per_shard=1, file_name_suffix=".bin")
+        # A fork that uploads to GCS, the dataset profiles in serialized form. Each worker bundle
+        # writes all of its profiles into a single file. The sink serializes them as it writes.
+        output_dir, output_prefix = FileSystems.split(args.output)
+        result | "Upload to GCS" >> WriteToFiles(
+            path=output_dir,
+            file_naming=default_file_naming(output_prefix or "profile", ".bin.zst"),
+            sink=DatasetProfileViewSink,
         )
 
 
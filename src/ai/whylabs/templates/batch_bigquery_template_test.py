@@ -1,6 +1,14 @@
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
 from . import batch_bigquery_template as p
+import apache_beam as beam
+from apache_beam.typehints.batch import BatchConverter, ListBatchConverter
+import pandas as pd
 import pytest
 from dateutil import tz
+from whylogs.core import DatasetProfile, DatasetProfileView
 
 
 def test_get_input_query() -> None:
@@ -19,6 +27,8 @@ def test_get_input_query() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     input = p.get_input(args)
@@ -43,6 +53,8 @@ def test_get_input_query_invalid_input() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     with pytest.raises(Exception) as e_info:
@@ -66,6 +78,8 @@ def test_get_input_table() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     input = p.get_input(args)
@@ -90,6 +104,8 @@ def test_get_input_table_invalid_input() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     with pytest.raises(Exception) as e_info:
@@ -113,6 +129,8 @@ def test_get_input_offset() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     input = p.get_input(args)
@@ -139,6 +157,8 @@ def test_get_input_offset_invalid_input() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     with pytest.raises(Exception) as e_info:
@@ -162,6 +182,8 @@ def test_get_input_offset_invalid_input_offset() -> None:
         logging_level="INFO",
         date_column="time_ts",
         date_grouping_frequency="D",
+        profile_threads=1,
+        columns=None,
     )
 
     input = p.get_input(args)
@@ -174,3 +196,285 @@ def test_get_input_offset_invalid_input_offset() -> None:
     assert input.table_spec == table
     assert input.offset == -1
     assert input.timezone == tz.gettz("UTC")
+
+
+def _template_args(
+    date_grouping_frequency: str = "D", profile_threads: int = 1, columns: Optional[str] = None
+) -> p.TemplateArgs:
+    return p.TemplateArgs(
+        input_mode=p.INPUT_MODE_BIGQUERY_TABLE,
+        input_bigquery_sql=None,
+        input_bigquery_table="bigquery-public-data:hacker_news.comments",
+        input_offset=None,
+        input_offset_today_override=None,
+        input_offset_table=None,
+        input_offset_timezone=None,
+        api_key="key",
+        output="gs://foo",
+        dataset_id="model-1",
+        org_id="org-0",
+        logging_level="INFO",
+        date_column="time_ts",
+        date_grouping_frequency=date_grouping_frequency,
+        profile_threads=profile_threads,
+        columns=columns,
+    )
+
+
+def test_get_selected_fields() -> None:
+    assert p.get_selected_fields(_template_args()) is None
+    assert p.get_selected_fields(_template_args(columns="")) is None
+    assert p.get_selected_fields(_template_args(columns="a, b,")) == ["a", "b", "time_ts"]
+    assert p.get_selected_fields(_template_args(columns="time_ts,a")) == ["time_ts", "a"]
+
+
+def test_get_read_input_selects_columns() -> None:
+    read = p.get_read_input(_template_args(columns="a,b"), logging.getLogger())
+    assert read._kwargs["selected_fields"] == ["a", "b", "time_ts"]
+
+
+def _profile_views(date_grouping_frequency: str) -> p.ProfileViews:
+    return p.ProfileViews(_template_args(date_grouping_frequency))
+
+
+@pytest.mark.parametrize("freq", ["D", "H", "7D", "Y"])
+def test_group_by_date_matches_grouper(freq: str) -> None:
+    start = datetime(2022, 1, 1, 5, 30, tzinfo=tz.tzutc())
+    rows = [{"time_ts": start + timedelta(hours=i * 7), "value": i} for i in range(100)]
+    rows.append({"time_ts": start + timedelta(days=900), "value": 100})
+    rows.append({"time_ts": None, "value": 101})
+    df = pd.DataFrame(rows)
+
+    expected = {
+        str(date_group): sorted(dataframe["value"])
+        for date_group, dataframe in df.set_index(pd.to_datetime(df["time_ts"])).groupby(pd.Grouper(freq=freq))
+        if len(dataframe) > 0
+    }
+
+    actual = {
+        str(date_group): sorted(dataframe["value"]) for date_group, dataframe in _profile_views(freq)._group_by_date(df)
+    }
+
+    assert actual == expected
+
+
+def test_group_by_date_parses_date_objects() -> None:
+    rows = [{"time_ts": date(2022, 1, 1) + timedelta(days=i // 3), "value": i} for i in range(9)]
+    df = p.rows_to_dataframe(rows)
+
+    actual = {
+        str(date_group): sorted(dataframe["value"]) for date_group, dataframe in _profile_views("D")._group_by_date(df)
+    }
+
+    assert actual == {
+        "2022-01-01 00:00:00": [0, 1, 2],
+        "2022-01-02 00:00:00": [3, 4, 5],
+        "2022-01-03 00:00:00": [6, 7, 8],
+    }
+
+
+@pytest.mark.parametrize("profile_threads", [1, 4])
+def test_profile_views_accumulates_bundle(profile_threads: int) -> None:
+    start = datetime(2022, 1, 1, tzinfo=tz.tzutc())
+    batches = [
+        [{"time_ts": start + timedelta(hours=i), "value": i} for i in range(j * 50, (j + 1) * 50)] for j in range(3)
+    ]
+    fn = p.ProfileViews(_template_args("D", profile_threads))
+
+    fn.setup()
+    fn.start_bundle()
+    for batch in batches:
+        fn.process(batch)
+    outputs = [windowed_value.value for windowed_value in fn.finish_bundle()]
+    fn.teardown()
+
+    counts = {date_str: view.get_column("value").get_metric("counts").n.value for date_str, view in outputs}
+    assert counts == {
+        "2022-01-01 00:00:00+00:00": 24,
+        "2022-01-02 00:00:00+00:00": 24,
+        "2022-01-03 00:00:00+00:00": 24,
+        "2022-01-04 00:00:00+00:00": 24,
+        "2022-01-05 00:00:00+00:00": 24,
+        "2022-01-06 00:00:00+00:00": 24,
+        "2022-01-07 00:00:00+00:00": 6,
+    }
+
+
+def test_dataset_profile_view_coder_round_trip() -> None:
+    profile = DatasetProfile(dataset_timestamp=datetime(2022, 1, 1, tzinfo=tz.tzutc()))
+    profile.track(pd.DataFrame({"value": range(100)}))
+    view = profile.view()
+
+    coder = beam.coders.registry.get_coder(Tuple[str, DatasetProfileView])
+    date_str, decoded = coder.decode(coder.encode(("2022-01-01", view)))
+
+    assert date_str == "2022-01-01"
+    assert decoded.dataset_timestamp == view.dataset_timestamp
+    assert decoded.get_column("value").get_metric("counts").n.value == 100
+
+
+def test_rows_to_dataframe_matches_pandas() -> None:
+    rows: List[Dict[str, Any]] = [
+        {"time_ts": datetime(2022, 1, 1, tzinfo=tz.tzutc()), "count": 1, "name": "a", "tags": ["x", "y"]},
+        {"time_ts": None, "count": None, "name": None, "tags": []},
+    ]
+
+    actual = p.rows_to_dataframe(rows)
+    expected = pd.DataFrame(rows)
+
+    pd.testing.assert_frame_equal(actual, expected)
+    assert actual["tags"][0] == ["x", "y"]
+
+    # REPEATED fields inside of RECORDs
+    nested_rows: List[Dict[str, Any]] = [
+        {"count": 1, "record": {"x": [1, 2], "y": "a"}, "records": [{"x": [3]}]},
+        {"count": 2, "record": {"x": [], "y": None}, "records": []},
+    ]
+    nested = p.rows_to_dataframe(nested_rows)
+    pd.testing.assert_frame_equal(nested, pd.DataFrame(nested_rows))
+    assert nested["record"][0] == {"x": [1, 2], "y": "a"}
+    assert nested["records"][0] == [{"x": [3]}]
+
+    # Keys that are missing from the first row
+    sparse_rows: List[Dict[str, Any]] = [{"a": 1}, {"a": 2, "b": 3}]
+    sparse = p.rows_to_dataframe(sparse_rows)
+    pd.testing.assert_frame_equal(sparse, pd.DataFrame(sparse_rows))
+    assert list(sparse.columns) == ["a", "b"]
+
+
+def test_rows_to_dataframe_out_of_range_timestamps() -> None:
+    rows: List[Dict[str, Any]] = [{"time_ts": datetime(1, 1, 1), "count": 1}]
+
+    df = p.rows_to_dataframe(rows)
+
+    assert df["time_ts"][0] == datetime(1, 1, 1)
+
+
+def test_view_combiner_merge_accumulators() -> None:
+    combiner = p.ViewCombiner(_template_args())
+    views = []
+    for i in range(3):
+        profile = DatasetProfile(dataset_timestamp=datetime(2050, 1, 1, tzinfo=tz.tzutc()))
+        profile.track(pd.DataFrame({"value": range(10 * i, 10 * (i + 1))}))
+        views.append(profile.view())
+
+    accumulator = combiner.add_input(combiner.create_accumulator(), views[0])
+    merged = combiner.merge_accumulators(view for view in [accumulator, None, views[1], views[2]])
+
+    assert merged is not None
+    assert merged.get_column("value").get_metric("counts").n.value == 30
+    # Future timestamps shouldn't be replaced by the time that the accumulator was created
+    assert merged.dataset_timestamp == datetime(2050, 1, 1, tzinfo=tz.tzutc())
+    assert combiner.merge_accumulators([]) is None
+
+
+def test_view_combiner_accumulator_coder() -> None:
+    coder = p.ViewCombiner(_template_args()).get_accumulator_coder()
+    profile = DatasetProfile()
+    profile.track(pd.DataFrame({"value": range(10)}))
+
+    assert coder.decode(coder.encode(None)) is None
+    assert coder.decode(coder.encode(profile.view())).get_column("value").get_metric("counts").n.value == 10
+
+
+class _FakeWriter:
+    def __init__(self) -> None:
+        self.written: List[DatasetProfileView] = []
+
+    def write(self, view: DatasetProfileView) -> Tuple[bool, str]:
+        self.written.append(view)
+        return True, "ok"
+
+
+def test_upload_to_whylabs_writes_bundle() -> None:
+    fn = p.UploadToWhylabsFn(_template_args())
+    fn.setup()
+    writer = _FakeWriter()
+    fn.writer = writer
+    views = [DatasetProfile().view() for _ in range(5)]
+
+    fn.start_bundle()
+    fn.process_batch([(str(i), view) for i, view in enumerate(views[:3])])
+    fn.process_batch([(str(i), view) for i, view in enumerate(views[3:])])
+    assert writer.written == []
+
+    fn.finish_bundle()
+    fn.teardown()
+    assert sorted(map(id, writer.written)) == sorted(map(id, views))
+
+
+def test_dataset_profile_view_sink_round_trip(tmp_path: Any) -> None:
+    views = []
+    for i in range(3):
+        profile = DatasetProfile()
+        profile.track(pd.DataFrame({"value": range(i + 1)}))
+        views.append(profile.view())
+
+    path = str(tmp_path / "profiles.bin.zst")
+    sink = p.DatasetProfileViewSink()
+    with p.FileSystems.create(path, **sink.create_metadata("", path)._asdict()) as f:
+        sink.open(f)
+        for view in views:
+            sink.write(("2022-01-01", view))
+        sink.flush()
+
+    with open(path, "rb") as raw:
+        assert raw.read(4) == b"\x28\xb5\x2f\xfd"  # zstd magic number
+    counts = [view.get_column("value").get_metric("counts").n.value for view in p.read_profiles(path)]
+    assert counts == [1, 2, 3]
+
+
+def test_serialize_view_is_cached() -> None:
+    profile = DatasetProfile()
+    profile.track(pd.DataFrame({"value": range(10)}))
+    view = profile.view()
+
+    serialized = p.serialize_view(view)
+    assert p.serialize_view(view) is serialized
+
+    deserialized = p.deserialize_view(serialized)
+    assert p.serialize_view(deserialized) is serialized
+
+
+def test_estimate_view_size() -> None:
+    profile = DatasetProfile()
+    profile.track(pd.DataFrame({"a": range(100), "b": [str(i) for i in range(100)]}))
+    view = profile.view()
+
+    metrics = sum(len(column.get_metric_names()) for column in view.get_columns().values())
+    estimate = p.estimate_view_size(view)
+    assert estimate == 2 * p.ESTIMATED_COLUMN_BYTES + metrics * p.ESTIMATED_METRIC_BYTES
+
+    serialized = p.serialize_view(view)
+    assert p.estimate_view_size(view) == len(serialized)
+
+
+def test_profile_index_batch_converter_covers_whole_batch() -> None:
+    views = []
+    for i in range(3):
+        profile = DatasetProfile()
+        profile.track(pd.DataFrame({"value": range(i + 1)}))
+        views.append(profile.view())
+
+    batch = [("2022-01-01", view) for view in views]
+    converter = BatchConverter.from_typehints(
+        element_type=Tuple[str, DatasetProfileView], batch_type=List[Tuple[str, DatasetProfileView]]
+    )
+    assert isinstance(converter, p.ProfileIndexBatchConverter)
+    assert converter.estimate_byte_size(batch) == sum(p.estimate_view_size(view) for view in views)
+    assert converter.estimate_byte_size([]) == 0
+
+
+def test_view_combiner_output_is_typed() -> None:
+    with beam.Pipeline() as pipeline:
+        views = pipeline | beam.Create([("2022-01-01", DatasetProfile().view())]).with_output_types(
+            Tuple[str, DatasetProfileView]
+        )
+        merged = views | beam.CombinePerKey(p.ViewCombiner(_template_args()))
+
+        assert merged.element_type == beam.typehints.Tuple[str, DatasetProfileView]
+
+
+def test_profile_index_batch_converter_only_claims_profile_batches() -> None:
+    converter = BatchConverter.from_typehints(element_type=Tuple[str, int], batch_type=List[Tuple[str, int]])
+    assert type(converter) is ListBatchConverter